@@ -1,39 +1,58 @@
+import asyncio
+import csv
+import io
+import json
+import logging
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Tuple
+from functools import lru_cache
+from typing import List, Optional, Tuple
 from pathlib import Path
 
 import streamlit as st
 from dotenv import load_dotenv
+from openai import APIConnectionError, APIError, InternalServerError, OpenAI, RateLimitError
 
 from langchain_openai import ChatOpenAI
+from langchain_core.messages import AIMessageChunk
 from langchain_core.tools import tool
 from langgraph.prebuilt import create_react_agent as create_react_agent_lg
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ENV (Secrets first, then .env; works on Cloud and locally)
 # ──────────────────────────────────────────────────────────────────────────────
-load_dotenv()
+@st.cache_resource
+def load_api_key() -> str:
+    """Resolve the key once per process; a missing key raises and is retried on the next run."""
+    load_dotenv()
 
-# Prefer Streamlit Secrets on Cloud; fallback to local .env for dev
-api_key = None
-try:
-    api_key = st.secrets.get("OPENAI_API_KEY")
-except Exception:
+    # Prefer Streamlit Secrets on Cloud; fallback to local .env for dev
     api_key = None
+    try:
+        api_key = st.secrets.get("OPENAI_API_KEY")
+    except Exception:
+        api_key = None
+
+    if not api_key:
+        api_key = os.getenv("OPENAI_API_KEY")
+
+    if not api_key:
+        raise ValueError(
+            "❌ OPENAI_API_KEY not found.\n"
+            "On Streamlit Cloud: set it in Settings → Secrets.\n"
+            "Locally: create a .env file with OPENAI_API_KEY=sk-...your key..."
+        )
 
-if not api_key:
-    api_key = os.getenv("OPENAI_API_KEY")
+    os.environ["OPENAI_API_KEY"] = api_key
+    return api_key
 
-if not api_key:
-    raise ValueError(
-        "❌ OPENAI_API_KEY not found.\n"
-        "On Streamlit Cloud: set it in Settings → Secrets.\n"
-        "Locally: create a .env file with OPENAI_API_KEY=sk-...your key..."
-    )
-
-os.environ["OPENAI_API_KEY"] = api_key
+api_key = load_api_key()
 
 # Optional visual confirmation
 st.caption("API key status: " + ("✅ found" if bool(api_key) else "❌ missing"))
@@ -46,6 +65,30 @@ ICON_PATH = Path("images/marcellina_icon.png")
 ASSISTANT_AVATAR = str(ICON_PATH) if ICON_PATH.exists() else "👩🏽‍⚕️"
 USER_AVATAR = "👤"
 
+LLM_MODEL = "gpt-4o-mini"
+LLM_TEMPERATURE = 0.5
+
+# Optional self-hosted quantized model (OpenAI-compatible server, e.g. vLLM/TGI with
+# int8 weights) for routine tool-only turns; unset = everything goes to LLM_MODEL
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL")  # e.g. http://localhost:8000/v1
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "qwen2.5-7b-instruct-int8")
+ROUTINE_MAX_WORDS = 25  # longer questions need the full model's reasoning
+
+BATCH_CONCURRENCY = 10  # max in-flight agent calls in Bulk mode
+BATCH_POLL_SECONDS = 60  # OpenAI Batch API status check interval
+MAX_BATCH_POLL_FAILURES = 3  # consecutive non-transient poll errors before a batch is marked failed
+MAX_SOAP_BUFFER = 50  # notes held in session state before a forced flush
+
+# Per-session scratch data dropped when the user goes back to the start
+# (Streamlit never clears session state when a tab closes)
+SESSION_SCRATCH_KEYS = (
+    "history_cache", "soap_cache", "soap_buffer", "pending_logs", "bulk_results",
+    "review_patient", "new_patient_candidate", "show_new_patient_confirm", "recent_batches",
+)
+TERMINAL_BATCH_STATES = ("completed", "failed", "expired", "cancelled")
+
+logger = logging.getLogger(__name__)
+
 # ──────────────────────────────────────────────────────────────────────────────
 # UI SETUP
 # ──────────────────────────────────────────────────────────────────────────────
@@ -55,60 +98,209 @@ st.title("👩🏽‍⚕️ Marcellina Medical Assistant")
 # ──────────────────────────────────────────────────────────────────────────────
 # DB SETUP
 # ──────────────────────────────────────────────────────────────────────────────
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cursor = conn.cursor()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS professionals (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT, category TEXT, role TEXT, created_at TEXT
+READER_POOL_SIZE = 4
+
+# All SQL in one place
+SQL_INSERT_LOG = "INSERT INTO chat_logs VALUES (NULL, ?, ?, ?, ?, ?)"
+SQL_FETCH_HISTORY = "SELECT sender, message FROM chat_logs WHERE patient_id=? ORDER BY id"
+SQL_FETCH_SOAP = "SELECT note FROM soap_notes WHERE patient_id=? ORDER BY id"
+SQL_INSERT_SOAP = "INSERT INTO soap_notes VALUES (NULL, ?, ?, ?, ?)"
+SQL_FIND_PATIENT = "SELECT id, name, age, sex, history FROM patients WHERE name=? AND age=? AND sex=?"
+SQL_INSERT_PROFESSIONAL = "INSERT INTO professionals VALUES (NULL, ?, ?, ?, ?)"
+SQL_INSERT_PATIENT = "INSERT INTO patients VALUES (NULL, ?, ?, ?, ?, ?)"
+SQL_INSERT_BATCH = "INSERT INTO batches VALUES (NULL, ?, ?, ?, NULL, ?, ?)"
+SQL_PENDING_BATCHES = (
+    "SELECT id, batch_id, prompts FROM batches WHERE status NOT IN "
+    f"({', '.join('?' * len(TERMINAL_BATCH_STATES))})"
 )
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS patients (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT, age INTEGER, sex TEXT, history TEXT, created_at TEXT
+SQL_UPDATE_BATCH = "UPDATE batches SET status=?, results=? WHERE id=?"
+# Stage 1 adds a professionals row per login, so batches are matched on name + role
+SQL_RECENT_BATCHES = (
+    "SELECT b.batch_id, b.status, b.created_at, b.results FROM batches b "
+    "JOIN professionals p ON p.id = b.professional_id "
+    "WHERE p.name=? AND p.role=? ORDER BY b.id DESC LIMIT 10"
 )
-""")
+SQL_FAQ_LOOKUP = "SELECT answer FROM faq WHERE query_key=?"
+SQL_FAQ_UPSERT = "INSERT OR REPLACE INTO faq VALUES (?, ?, ?, ?)"
+SQL_FAQ_CLEAR = "DELETE FROM faq"
+# Each user message paired with the assistant reply that followed it for the same patient,
+# oldest first (refresh_faq keeps the last answer it sees)
+SQL_QA_PAIRS = """
+SELECT message, reply FROM (
+    SELECT id, sender, message,
+           LEAD(sender) OVER w AS next_sender,
+           LEAD(message) OVER w AS reply
+    FROM chat_logs
+    WINDOW w AS (PARTITION BY patient_id ORDER BY id)
+) WHERE sender='user' AND next_sender='assistant'
+ORDER BY id
+"""
+
+def _configure(c: sqlite3.Connection):
+    # WAL lets readers run alongside a writer; busy_timeout waits out short locks
+    # instead of failing with "database is locked".
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA busy_timeout=5000")
+    c.execute("PRAGMA cache_size=-32000")
+
+@st.cache_resource
+def open_db():
+    """One writer (guarded by a lock) + a queue of read-only connections, shared by all sessions."""
+    writer = sqlite3.connect(DB_FILE, check_same_thread=False)
+    _configure(writer)
+
+    writer.execute("""
+    CREATE TABLE IF NOT EXISTS professionals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT, category TEXT, role TEXT, created_at TEXT
+    )
+    """)
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS chat_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    patient_id INTEGER, professional_id INTEGER,
-    sender TEXT, message TEXT, timestamp TEXT
-)
-""")
+    writer.execute("""
+    CREATE TABLE IF NOT EXISTS patients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT, age INTEGER, sex TEXT, history TEXT, created_at TEXT
+    )
+    """)
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS soap_notes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    patient_id INTEGER, professional_id INTEGER,
-    note TEXT, timestamp TEXT
-)
-""")
-conn.commit()
+    writer.execute("""
+    CREATE TABLE IF NOT EXISTS chat_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER, professional_id INTEGER,
+        sender TEXT, message TEXT, timestamp TEXT
+    )
+    """)
+
+    writer.execute("""
+    CREATE TABLE IF NOT EXISTS soap_notes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER, professional_id INTEGER,
+        note TEXT, timestamp TEXT
+    )
+    """)
+
+    writer.execute("""
+    CREATE TABLE IF NOT EXISTS batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        batch_id TEXT, status TEXT, prompts TEXT, results TEXT, created_at TEXT,
+        professional_id INTEGER
+    )
+    """)
+
+    # (patient_id, id) serves the per-patient lookups and their ORDER BY id without a sort
+    writer.execute("CREATE INDEX IF NOT EXISTS idx_chat_logs_pid ON chat_logs(patient_id, id)")
+    writer.execute("CREATE INDEX IF NOT EXISTS idx_soap_pid ON soap_notes(patient_id, id)")
+
+    # WITHOUT ROWID clusters rows on query_key, so a lookup is a single covering-index probe
+    writer.execute("""
+    CREATE TABLE IF NOT EXISTS faq (
+        query_key TEXT PRIMARY KEY, answer TEXT, hits INTEGER, updated_at TEXT
+    ) WITHOUT ROWID
+    """)
+    writer.commit()
+
+    readers = queue.Queue()
+    for _ in range(READER_POOL_SIZE):
+        r = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+        _configure(r)
+        r.execute("PRAGMA query_only=true")
+        readers.put(r)
+    return writer, threading.Lock(), readers
+
+conn, write_lock, readers = open_db()
+
+@contextmanager
+def reader():
+    c = readers.get()
+    try:
+        yield c
+    finally:
+        readers.put(c)
+
+def db_write(sql: str, params: tuple) -> int:
+    """Run one INSERT on the writer and commit; returns lastrowid."""
+    with write_lock:
+        cur = conn.execute(sql, params)
+        conn.commit()
+        return cur.lastrowid
+
+def db_write_many(sql: str, rows: list):
+    """executemany on the writer with a single commit (one fsync for the batch)."""
+    if not rows:
+        return
+    with write_lock:
+        conn.executemany(sql, rows)
+        conn.commit()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # LLM
 # ──────────────────────────────────────────────────────────────────────────────
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.5)
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # One long-lived loop per process. The cached agent's async OpenAI client keeps
+    # keep-alive connections bound to the loop that opened them, so every coroutine
+    # runs here rather than in a throwaway asyncio.run() loop per rerun.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-loop", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """Run a coroutine on the shared loop and block the script until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+def iter_async(agen):
+    """Drive an async generator on the shared loop as a plain iterator (for st.write_stream)."""
+    loop = get_event_loop()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
 
 # ──────────────────────────────────────────────────────────────────────────────
 # TOOLS
 # ──────────────────────────────────────────────────────────────────────────────
+@lru_cache(maxsize=256)
+def normalize(text: str) -> str:
+    # The model usually passes the user's own text to several tools (and the
+    # scope check sees it first), so the lowered copy is shared, not rebuilt.
+    return text.lower()
+
+def _keyword_pattern(words) -> "re.Pattern":
+    # One alternation = one scan of the text; same substring semantics as `k in t`
+    return re.compile("|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)))
+
+# Static trigger → response tables; add a rule by adding an entry
+SYMPTOM_RULES = {
+    "fever": "Likely causes: Infection, flu, or COVID-19.",
+    "headache": "Possible causes: Migraine, tension, high blood pressure.",
+}
+DIFFERENTIAL_RULES = {
+    "chest pain": "Differentials: MI, angina, GERD, anxiety.",
+}
+LAB_RULES = {
+    "fatigue": "Recommended tests: CBC, Iron studies, TSH.",
+}
+SYMPTOM_RE = _keyword_pattern(SYMPTOM_RULES)
+DIFFERENTIAL_RE = _keyword_pattern(DIFFERENTIAL_RULES)
+LAB_RE = _keyword_pattern(LAB_RULES)
+
+def match_rule(pattern: "re.Pattern", rules: dict, text: str, default: str) -> str:
+    # First trigger found in the text wins
+    m = pattern.search(normalize(text))
+    return rules[m.group(0)] if m else default
+
+# Coroutine tools: when the model emits several tool calls in one step, the
+# ToolNode's async path awaits them together (asyncio.gather), so the tool
+# phase costs max(tool) instead of sum(tool).
 @tool
-def symptom_checker(text: str) -> str:
+async def symptom_checker(text: str) -> str:
     """Check likely causes of symptoms."""
-    t = text.lower()
-    if "fever" in t:
-        return "Likely causes: Infection, flu, or COVID-19."
-    if "headache" in t:
-        return "Possible causes: Migraine, tension, high blood pressure."
-    return "Please provide more symptoms for accurate suggestions."
+    return match_rule(SYMPTOM_RE, SYMPTOM_RULES, text, "Please provide more symptoms for accurate suggestions.")
 
 @tool
-def clinical_note_generator(text: str) -> str:
+async def clinical_note_generator(text: str) -> str:
     """Generate a SOAP note."""
     note = (
         f"📝 **SOAP Note**\n"
@@ -117,30 +309,25 @@ def clinical_note_generator(text: str) -> str:
         f"- **Assessment:** Based on symptom analysis\n"
         f"- **Plan:** Follow-up or further testing."
     )
-    st.session_state.setdefault("soap_buffer", []).append(note)
-    return note
+    return note  # collected into the SOAP buffer by the chat handler
 
 @tool
-def drug_interaction_checker(text: str) -> str:
+async def drug_interaction_checker(text: str) -> str:
     """Check for drug interactions."""
-    drugs = [d.strip().lower() for d in text.split(",")]
+    drugs = [d.strip() for d in normalize(text).split(",")]
     if "aspirin" in drugs and "warfarin" in drugs:
         return "⚠️ Aspirin + Warfarin = increased bleeding risk."
     return "✅ No major interactions found."
 
 @tool
-def differential_diagnosis(text: str) -> str:
+async def differential_diagnosis(text: str) -> str:
     """Suggest possible conditions."""
-    if "chest pain" in text.lower():
-        return "Differentials: MI, angina, GERD, anxiety."
-    return "Need more details for differential diagnosis."
+    return match_rule(DIFFERENTIAL_RE, DIFFERENTIAL_RULES, text, "Need more details for differential diagnosis.")
 
 @tool
-def lab_test_recommendation(text: str) -> str:
+async def lab_test_recommendation(text: str) -> str:
     """Suggest lab tests."""
-    if "fatigue" in text.lower():
-        return "Recommended tests: CBC, Iron studies, TSH."
-    return "Consider basic labs: CBC, BMP."
+    return match_rule(LAB_RE, LAB_RULES, text, "Consider basic labs: CBC, BMP.")
 
 tools = [
     symptom_checker,
@@ -171,50 +358,353 @@ SYSTEM_PROMPT = (
     "4) Include a brief safety reminder when appropriate (e.g., seek urgent care if red flags)."
 )
 
-# Some langgraph versions accept state_modifier, others messages_modifier; some neither.
-_NEED_SYSTEM_PER_CALL = False
-try:
-    agent_executor = create_react_agent_lg(model=llm, tools=tools, state_modifier=SYSTEM_PROMPT)
-except TypeError:
+@st.cache_resource
+def get_agent(model: str = LLM_MODEL, base_url: Optional[str] = None):
+    """Build the LLM + agent once per process so its HTTP connection pool is shared by all sessions."""
+    if base_url:
+        # Local server: don't forward the OpenAI key
+        llm = ChatOpenAI(
+            model=model, temperature=LLM_TEMPERATURE, streaming=True,
+            base_url=base_url, api_key=os.getenv("LOCAL_LLM_API_KEY", "EMPTY"),
+        )
+    else:
+        llm = ChatOpenAI(model=model, temperature=LLM_TEMPERATURE, streaming=True)
+
+    # Some langgraph versions accept state_modifier, others messages_modifier; some neither.
     try:
-        agent_executor = create_react_agent_lg(model=llm, tools=tools, messages_modifier=SYSTEM_PROMPT)
+        return create_react_agent_lg(model=llm, tools=tools, state_modifier=SYSTEM_PROMPT), False
     except TypeError:
-        agent_executor = create_react_agent_lg(model=llm, tools=tools)
-        _NEED_SYSTEM_PER_CALL = True  # we’ll prepend the system message on each invoke
+        try:
+            return create_react_agent_lg(model=llm, tools=tools, messages_modifier=SYSTEM_PROMPT), False
+        except TypeError:
+            # we’ll prepend the system message on each invoke
+            return create_react_agent_lg(model=llm, tools=tools), True
+
+agent_executor, _NEED_SYSTEM_PER_CALL = get_agent()
+router_agent = get_agent(LOCAL_LLM_MODEL, LOCAL_LLM_BASE_URL)[0] if LOCAL_LLM_BASE_URL else None
+
+# Inputs that hit a tool trigger and are short are routine: the tools do the work
+TOOL_TRIGGER_RE = _keyword_pattern([
+    *SYMPTOM_RULES, *DIFFERENTIAL_RULES, *LAB_RULES, "soap note", "interaction",
+])
+
+def is_routine_turn(text: str) -> bool:
+    t = normalize(text)
+    return len(t.split()) <= ROUTINE_MAX_WORDS and TOOL_TRIGGER_RE.search(t) is not None
+
+def pick_agent(user_input: str):
+    if router_agent is not None and is_routine_turn(user_input):
+        return router_agent
+    return agent_executor
 
 # ──────────────────────────────────────────────────────────────────────────────
 # HELPERS
 # ──────────────────────────────────────────────────────────────────────────────
+def build_messages(user_input: str) -> list:
+    # Prepend the system message if this langgraph build didn’t accept a modifier
+    msgs = [("user", user_input)]
+    if _NEED_SYSTEM_PER_CALL:
+        msgs = [("system", SYSTEM_PROMPT)] + msgs
+    return msgs
+
+def soap_notes_from(messages) -> List[str]:
+    # Tool results run on the shared loop (no session there), so notes are picked out here
+    return [
+        m.content for m in messages
+        if getattr(m, "type", None) == "tool" and getattr(m, "name", None) == clinical_note_generator.name
+    ]
+
+async def handle_turn(user_input: str) -> Tuple[str, List[str]]:
+    # LangGraph expects {"messages": ...} and returns state with a messages list.
+    # ainvoke keeps the OpenAI round-trip and tool calls off the blocking path.
+    agent = pick_agent(user_input)
+    try:
+        state = await agent.ainvoke({"messages": build_messages(user_input)})
+    except APIError as e:
+        if agent is agent_executor:
+            raise
+        logger.warning("Local model failed, falling back to %s: %s", LLM_MODEL, e)
+        state = await agent_executor.ainvoke({"messages": build_messages(user_input)})
+    last_msg = state["messages"][-1]
+    return getattr(last_msg, "content", str(last_msg)), soap_notes_from(state["messages"])
+
+async def process_batch(prompts: List[str], max_concurrency: int = BATCH_CONCURRENCY) -> List[str]:
+    # Fan a worklist out to the agent; the semaphore keeps us under provider rate limits
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def one(q: str) -> str:
+        is_ok, reason = validate_question(q)
+        if not is_ok:
+            return reason
+        async with sem:
+            try:
+                reply, _ = await handle_turn(q)
+                return reply
+            except Exception as e:
+                return f"⚠️ Could not process: {e}"
+
+    return await asyncio.gather(*map(one, prompts))
+
+def read_questions(raw: bytes) -> List[str]:
+    # First CSV column, optional "question" header row
+    rows = [r for r in csv.reader(io.StringIO(raw.decode("utf-8-sig"))) if r and r[0].strip()]
+    if rows and rows[0][0].strip().lower() == "question":
+        rows = rows[1:]
+    return [r[0].strip() for r in rows]
+
+def results_csv(results: List[dict]) -> str:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=["question", "answer"])
+    writer.writeheader()
+    writer.writerows(results)
+    return out.getvalue()
+
+# ──────────────────────────────────────────────────────────────────────────────
+# OPENAI BATCH API (non-interactive worklists: ~50% cheaper, results within 24h)
+# ──────────────────────────────────────────────────────────────────────────────
+@st.cache_resource
+def get_openai_client() -> OpenAI:
+    return OpenAI()
+
+def submit_batch(prompts: List[str], profid: int) -> str:
+    """Upload valid prompts as a /v1/chat/completions batch; returns the batch id."""
+    lines = []
+    for i, q in enumerate(prompts):
+        if not validate_question(q)[0]:
+            continue  # answered locally with the canned reason when results are collected
+        lines.append(json.dumps({
+            "custom_id": f"q-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": LLM_MODEL,
+                "temperature": LLM_TEMPERATURE,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": q},
+                ],
+            },
+        }))
+    if not lines:
+        raise ValueError("No medical questions to submit.")
+    client = get_openai_client()
+    batch_file = client.files.create(
+        file=("marcellina_batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+    )
+    db_write(SQL_INSERT_BATCH, (batch.id, batch.status, json.dumps(prompts), datetime.now().isoformat(), profid))
+    return batch.id
+
+def collect_batch_results(prompts: List[str], output_jsonl: str) -> List[dict]:
+    answers = {}
+    for line in output_jsonl.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        body = (item.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or []
+        if choices:
+            answers[item["custom_id"]] = choices[0]["message"]["content"]
+        else:
+            answers[item["custom_id"]] = f"⚠️ Could not process: {item.get('error') or body.get('error')}"
+    results = []
+    for i, q in enumerate(prompts):
+        is_ok, reason = validate_question(q)
+        results.append({"question": q, "answer": answers.get(f"q-{i}", "⚠️ No result") if is_ok else reason})
+    return results
+
+def fetch_batch(client: OpenAI, batch_id: str, prompts: str) -> Tuple[str, Optional[str]]:
+    """Current status of one batch, plus its collected results (JSON) once it is terminal."""
+    batch = client.batches.retrieve(batch_id)
+    results = None
+    # Failed requests land in error_file_id (an all-failed batch still ends "completed")
+    file_ids = [f for f in (batch.output_file_id, batch.error_file_id) if f]
+    if batch.status in TERMINAL_BATCH_STATES and file_ids:
+        output = "\n".join(client.files.content(f).text for f in file_ids)
+        results = json.dumps(collect_batch_results(json.loads(prompts), output))
+    return batch.status, results
+
+def load_recent_batches():
+    # Read on demand (Refresh / after submit), not on every Stage 3 rerun
+    with reader() as c:
+        st.session_state["recent_batches"] = c.execute(
+            SQL_RECENT_BATCHES, (st.session_state.professional_name, st.session_state.professional_role)
+        ).fetchall()
+
+def poll_batches(client: OpenAI, failures: dict):
+    # failures: row id -> consecutive non-transient errors, kept by the poller thread
+    with reader() as c:
+        pending = c.execute(SQL_PENDING_BATCHES, TERMINAL_BATCH_STATES).fetchall()
+    for row_id, batch_id, prompts in pending:
+        try:
+            status, results = fetch_batch(client, batch_id, prompts)
+        except (APIConnectionError, RateLimitError, InternalServerError) as e:
+            logger.warning("Could not poll batch %s, retrying next tick: %s", batch_id, e)
+            continue
+        except Exception:
+            # 4xx, missing/expired files, malformed output: counted, and never blocks other batches
+            failures[row_id] = failures.get(row_id, 0) + 1
+            if failures[row_id] >= MAX_BATCH_POLL_FAILURES:
+                logger.error("Giving up on batch %s after %d errors", batch_id, failures.pop(row_id), exc_info=True)
+                db_write(SQL_UPDATE_BATCH, ("failed", None, row_id))
+            else:
+                logger.warning("Could not poll batch %s", batch_id, exc_info=True)
+            continue
+        failures.pop(row_id, None)
+        db_write(SQL_UPDATE_BATCH, (status, results, row_id))
+
+@st.cache_resource
+def start_batch_poller() -> threading.Thread:
+    # One daemon thread per process; touches only the DB and OpenAI, never session state
+    client = get_openai_client()
+    failures = {}
+
+    def loop():
+        while True:
+            try:
+                poll_batches(client, failures)
+            except Exception:
+                logger.exception("Batch poll failed; retrying in %ss", BATCH_POLL_SECONDS)
+            time.sleep(BATCH_POLL_SECONDS)
+
+    t = threading.Thread(target=loop, name="batch-poller", daemon=True)
+    t.start()
+    return t
+
 def log_msg(pid: int, profid: int, sender: str, msg: str):
-    cursor.execute(
-        "INSERT INTO chat_logs VALUES (NULL, ?, ?, ?, ?, ?)",
+    # Buffered; written by flush_logs() at the end of the turn
+    st.session_state.setdefault("pending_logs", []).append(
         (pid, profid, sender, msg, datetime.now().isoformat())
     )
-    conn.commit()
+    cached = st.session_state.get("history_cache", {}).get(pid)
+    if cached is not None:
+        cached.append((sender, msg))
+
+def flush_logs():
+    # Cleared only after the write succeeds, so a failed insert is retried next flush
+    db_write_many(SQL_INSERT_LOG, st.session_state.get("pending_logs", []))
+    st.session_state["pending_logs"] = []
 
 def fetch_history(pid: int) -> List[Tuple[str, str]]:
-    cursor.execute("SELECT sender, message FROM chat_logs WHERE patient_id=?", (pid,))
-    return cursor.fetchall()
+    with reader() as c:
+        return c.execute(SQL_FETCH_HISTORY, (pid,)).fetchall()
 
 def fetch_soap(pid: int) -> List[str]:
-    cursor.execute("SELECT note FROM soap_notes WHERE patient_id=?", (pid,))
-    return [n[0] for n in cursor.fetchall()]
+    with reader() as c:
+        rows = c.execute(SQL_FETCH_SOAP, (pid,)).fetchall()
+    return [n[0] for n in rows]
 
 def save_soap(pid: int, profid: int):
-    for note in st.session_state.get("soap_buffer", []):
-        cursor.execute(
-            "INSERT INTO soap_notes VALUES (NULL, ?, ?, ?, ?)",
-            (pid, profid, note, datetime.now().isoformat())
-        )
-    conn.commit()
+    ts = datetime.now().isoformat()
+    notes = st.session_state.get("soap_buffer", [])
+    db_write_many(
+        SQL_INSERT_SOAP,
+        [(pid, profid, note, ts) for note in notes]
+    )
+    cached = st.session_state.get("soap_cache", {}).get(pid)
+    if cached is not None:
+        cached.extend(notes)
     st.session_state["soap_buffer"] = []
 
+def buffer_soap(pid: int, profid: int, notes: List[str]):
+    buf = st.session_state.setdefault("soap_buffer", [])
+    buf.extend(notes)
+    if len(buf) >= MAX_SOAP_BUFFER:
+        save_soap(pid, profid)
+
+def clear_session_data():
+    # Persist anything still buffered, then drop caches and form scratch values
+    flush_logs()
+    if st.session_state.get("soap_buffer") and "patient_id" in st.session_state:
+        save_soap(st.session_state.patient_id, st.session_state.professional_id)
+    for key in list(st.session_state.keys()):
+        if key.startswith("tmp_") or key in SESSION_SCRATCH_KEYS:
+            del st.session_state[key]
+
+def _cached(key: str, pid: int, loader):
+    # One patient per cache; a different pid replaces (invalidates) the old entry
+    cache = st.session_state.get(key, {})
+    if pid not in cache:
+        cache = {pid: loader(pid)}
+        st.session_state[key] = cache
+    return cache[pid]
+
+def cached_history(pid: int) -> List[Tuple[str, str]]:
+    return _cached("history_cache", pid, fetch_history)
+
+def cached_soap(pid: int) -> List[str]:
+    return _cached("soap_cache", pid, fetch_soap)
+
 def find_patient(name: str, age: int, sex: str):
-    cursor.execute(
-        "SELECT id, name, age, sex, history FROM patients WHERE name=? AND age=? AND sex=?",
-        (name.strip(), int(age), sex.strip())
-    )
-    return cursor.fetchone()
+    with reader() as c:
+        return c.execute(
+            SQL_FIND_PATIENT,
+            (name.strip(), int(age), sex.strip())
+        ).fetchone()
+
+async def afetch_patient_records(pid: int) -> Tuple[List[str], List[Tuple[str, str]]]:
+    # Each SELECT runs on a worker thread with its own pooled reader, so both run at the same time
+    return tuple(await asyncio.gather(
+        asyncio.to_thread(fetch_soap, pid), asyncio.to_thread(fetch_history, pid)
+    ))
+
+def prefetch_patient(pid: int):
+    """Fill the SOAP + history caches for pid in one concurrent round-trip."""
+    if pid in st.session_state.get("soap_cache", {}) and pid in st.session_state.get("history_cache", {}):
+        return
+    notes, chats = run_async(afetch_patient_records(pid))
+    st.session_state["soap_cache"] = {pid: notes}
+    st.session_state["history_cache"] = {pid: chats}
+
+async def _astream_agent(agent, user_input: str, turn: dict):
+    tool_steps, streamed = set(), set()  # model message ids
+    async for mode, payload in agent.astream(
+        {"messages": build_messages(user_input)}, stream_mode=["messages", "updates"]
+    ):
+        if mode == "messages":
+            chunk, _meta = payload
+            if not isinstance(chunk, AIMessageChunk):
+                continue
+            if chunk.tool_call_chunks:
+                # A tool-calling step: drop its text; if a preamble already went out,
+                # keep it apart from the answer that follows
+                if chunk.id in streamed and chunk.id not in tool_steps:
+                    yield "\n\n"
+                tool_steps.add(chunk.id)
+                continue
+            if chunk.id not in tool_steps and isinstance(chunk.content, str) and chunk.content:
+                streamed.add(chunk.id)
+                yield chunk.content
+        elif isinstance(payload, dict):
+            for update in payload.values():
+                if not isinstance(update, dict):
+                    continue
+                for m in update.get("messages", []):
+                    if getattr(m, "type", None) == "ai" and not getattr(m, "tool_calls", None):
+                        turn["answer"] = m.content
+                turn["notes"].extend(soap_notes_from(update.get("messages", [])))
+
+async def astream_turn(user_input: str, turn: dict):
+    # Yield the model's answer tokens as they arrive. Fills turn["notes"] with SOAP notes
+    # from tool steps and turn["answer"] with the final (tool-free) model message.
+    agent = pick_agent(user_input)
+    if agent is not agent_executor:
+        yielded = False
+        try:
+            async for text in _astream_agent(agent, user_input, turn):
+                yielded = True
+                yield text
+            return
+        except APIError as e:
+            if yielded:
+                raise  # part of the answer is already on screen
+            logger.warning("Local model failed, falling back to %s: %s", LLM_MODEL, e)
+            turn["notes"].clear()
+            turn["answer"] = None
+    async for text in _astream_agent(agent_executor, user_input, turn):
+        yield text
 
 # ──────────────────────────────────────────────────────────────────────────────
 # MEDICAL VALIDATION
@@ -235,16 +725,20 @@ NON_MEDICAL_CLUES = [
     "holiday","politics","election","car review","technology"
 ]
 
+MEDICAL_RE = _keyword_pattern(MEDICAL_HINTS)
+NON_MEDICAL_RE = _keyword_pattern(NON_MEDICAL_CLUES)
+
 def is_medical_query(text: str) -> bool:
-    t = text.lower()
-    if any(k in t for k in NON_MEDICAL_CLUES):
+    t = normalize(text)
+    if NON_MEDICAL_RE.search(t):
         return False
-    return any(k in t for k in MEDICAL_HINTS)
+    return MEDICAL_RE.search(t) is not None
 
 def validate_question(text: str) -> Tuple[bool, str]:
-    if not text or not text.strip():
+    stripped = text.strip() if text else ""
+    if not stripped:
         return False, "Please enter a medical or healthcare-related question."
-    if len(text.strip()) < 3:
+    if len(stripped) < 3:
         return False, "Your question is too short. Please add more detail."
     if not is_medical_query(text):
         return False, (
@@ -254,6 +748,69 @@ def validate_question(text: str) -> Tuple[bool, str]:
         )
     return True, ""
 
+# ──────────────────────────────────────────────────────────────────────────────
+# FAQ CACHE (recurring questions answered locally, no LLM call)
+# ──────────────────────────────────────────────────────────────────────────────
+FAQ_MIN_REPEATS = 2  # a question must have been asked this often to be cached
+# Only filler words; connectives, modals and wh-words ("with", "or", "after",
+# "should", "how", ...) change a clinical question's meaning and stay in the key
+FAQ_STOPWORDS = frozenset(["a", "an", "the", "please", "hi", "hello", "hey"])
+
+# Questions that would run a tool (SOAP notes go to the patient record; drug
+# interactions must never be answered from another question's reply)
+FAQ_EXCLUDE_RE = _keyword_pattern(["soap", "note", "interact", "aspirin", "warfarin"])
+
+def faq_eligible(q: str) -> bool:
+    t = normalize(q)
+    return TOOL_TRIGGER_RE.search(t) is None and FAQ_EXCLUDE_RE.search(t) is None
+
+def canonicalize(q: str) -> str:
+    # lowercase, collapse whitespace, drop filler words and trailing ?/!/. only;
+    # operators, signs and decimal points ("> 180/110", "-2", "0.5") stay in the key
+    words = normalize(q).strip().rstrip("?!.").split()
+    return " ".join(w for w in words if w not in FAQ_STOPWORDS)
+
+# Opposite clinical questions must never share a cached answer
+assert canonicalize("Is BP > 180/110 a hypertensive emergency?") != canonicalize("Is BP < 180/110 a hypertensive emergency?")
+assert canonicalize("INR of -2") != canonicalize("INR of 2")
+
+def lookup_faq(q: str) -> Optional[str]:
+    if not faq_eligible(q):
+        return None
+    key = canonicalize(q)
+    if not key:
+        return None
+    with reader() as c:
+        row = c.execute(SQL_FAQ_LOOKUP, (key,)).fetchone()
+    return row[0] if row else None
+
+def refresh_faq() -> int:
+    """Rebuild FAQ entries from questions that recurred in chat_logs; returns the entry count."""
+    seen = {}
+    with reader() as c:
+        for question, reply in c.execute(SQL_QA_PAIRS):
+            if not reply or reply.startswith("⚠️") or not validate_question(question)[0] or not faq_eligible(question):
+                continue
+            key = canonicalize(question)
+            if key:
+                hits, _ = seen.get(key, (0, None))
+                seen[key] = (hits + 1, reply)  # keep the most recent answer
+    ts = datetime.now().isoformat()
+    rows = [(key, reply, hits, ts) for key, (hits, reply) in seen.items() if hits >= FAQ_MIN_REPEATS]
+    # Full rebuild in one transaction, so keys from an older canonical form can't linger
+    with write_lock:
+        conn.execute(SQL_FAQ_CLEAR)
+        conn.executemany(SQL_FAQ_UPSERT, rows)
+        conn.commit()
+    return len(rows)
+
+@st.cache_resource
+def load_faq() -> int:
+    return refresh_faq()  # once per process
+
+load_faq()
+start_batch_poller()
+
 # ──────────────────────────────────────────────────────────────────────────────
 # STATE MANAGEMENT
 # ──────────────────────────────────────────────────────────────────────────────
@@ -281,13 +838,12 @@ if st.session_state.stage == "pro_greeting":
     name = st.text_input("Your Name")
 
     if st.button("Continue") and name.strip():
-        cursor.execute(
-            "INSERT INTO professionals VALUES (NULL, ?, ?, ?, ?)",
+        st.session_state.professional_id = db_write(
+            SQL_INSERT_PROFESSIONAL,
             (name.strip(), category, role, datetime.now().isoformat())
         )
-        conn.commit()
-        st.session_state.professional_id = cursor.lastrowid
         st.session_state.professional_name = name.strip()
+        st.session_state.professional_role = role
         st.session_state.stage = "patient_form"
         st.rerun()
 
@@ -307,12 +863,11 @@ elif st.session_state.stage == "patient_form":
         colA, colB = st.columns(2)
         with colA:
             if st.button("✅ Confirm & Continue"):
-                cursor.execute(
-                    "INSERT INTO patients VALUES (NULL, ?, ?, ?, ?, ?)",
+                st.session_state.patient_id = db_write(
+                    SQL_INSERT_PATIENT,
                     (cand["name"].strip(), int(cand["age"]), cand["sex"], cand["history"].strip(), datetime.now().isoformat())
                 )
-                conn.commit()
-                st.session_state.patient_id = cursor.lastrowid
+                st.session_state.patient_name = cand["name"].strip()
                 st.session_state.chat_mode = "new"
                 st.session_state.show_new_patient_confirm = False
                 st.session_state.new_patient_candidate = {}
@@ -325,6 +880,7 @@ elif st.session_state.stage == "patient_form":
                 st.rerun()
 
         if st.button("← Back"):
+            clear_session_data()
             st.session_state.stage = "pro_greeting"
             st.rerun()
 
@@ -367,6 +923,7 @@ elif st.session_state.stage == "patient_form":
             st.rerun()
 
     if st.button("← Back"):
+        clear_session_data()
         st.session_state.stage = "pro_greeting"
         st.rerun()
 
@@ -382,8 +939,10 @@ elif st.session_state.stage == "patient_review":
     st.write(f"**Sex:** {data.get('sex')}")
     st.write(f"**History:** {data.get('history')}")
 
+    prefetch_patient(pid)
+
     st.markdown("**Previous SOAP Notes:**")
-    notes = fetch_soap(pid)
+    notes = cached_soap(pid)
     if notes:
         for n in notes:
             st.markdown(n)
@@ -391,7 +950,7 @@ elif st.session_state.stage == "patient_review":
         st.write("— None recorded —")
 
     st.markdown("**Previous Chat History:**")
-    chats = fetch_history(pid)
+    chats = cached_history(pid)
     if chats:
         for sender, msg in chats:
             if sender == "user":
@@ -407,6 +966,7 @@ elif st.session_state.stage == "patient_review":
     with col1:
         if st.button("➡️ Continue with this patient"):
             st.session_state.patient_id = pid
+            st.session_state.patient_name = data.get("name")
             st.session_state.chat_mode = "existing"
             st.session_state.stage = "chat"
             st.session_state.pop("review_patient", None)
@@ -419,12 +979,11 @@ elif st.session_state.stage == "patient_review":
             psex  = st.session_state.get("tmp_psex", data.get("sex", "Other"))
             phist = st.session_state.get("tmp_phist", data.get("history", ""))
 
-            cursor.execute(
-                "INSERT INTO patients VALUES (NULL, ?, ?, ?, ?, ?)",
+            st.session_state.patient_id = db_write(
+                SQL_INSERT_PATIENT,
                 (pname.strip(), page, psex, phist.strip(), datetime.now().isoformat())
             )
-            conn.commit()
-            st.session_state.patient_id = cursor.lastrowid
+            st.session_state.patient_name = pname.strip()
             st.session_state.chat_mode = "new"
             st.session_state.stage = "chat"
             st.session_state.pop("review_patient", None)
@@ -438,9 +997,8 @@ elif st.session_state.stage == "patient_review":
 elif st.session_state.stage == "chat":
     professional_name = st.session_state.get("professional_name", "User")
 
-    # Patient name for header + welcome
-    cursor.execute("SELECT name FROM patients WHERE id=?", (st.session_state.patient_id,))
-    patient_name = cursor.fetchone()[0]
+    # Patient name for header + welcome (set when the patient was chosen/created)
+    patient_name = st.session_state.patient_name
 
     # Welcome banner
     if st.session_state.get("chat_mode") == "existing":
@@ -450,7 +1008,7 @@ elif st.session_state.stage == "chat":
 
     # History hidden by default; available on demand
     with st.expander("Show previous conversation (optional)", expanded=False):
-        prev = fetch_history(st.session_state.patient_id)
+        prev = cached_history(st.session_state.patient_id)
         if not prev:
             st.caption("No previous messages saved.")
         else:
@@ -462,6 +1020,52 @@ elif st.session_state.stage == "chat":
                     with st.chat_message(ASSISTANT_NAME, avatar=ASSISTANT_AVATAR):
                         st.markdown(msg)
 
+    # Bulk mode: answer a CSV worklist concurrently (not logged to this patient)
+    with st.expander("Bulk mode (CSV upload)", expanded=False):
+        upload = st.file_uploader("One question per row (first column)", type=["csv"])
+        bulk_mode = st.radio(
+            "Run mode",
+            ["Now (concurrent)", "OpenAI Batch API (≤24h, lower cost)"],
+            horizontal=True,
+        )
+        if upload is not None:
+            if bulk_mode.startswith("OpenAI"):
+                if st.button("Submit batch"):
+                    try:
+                        batch_id = submit_batch(read_questions(upload.getvalue()), st.session_state.professional_id)
+                        st.success(f"Submitted batch `{batch_id}`; results appear below once it completes.")
+                        load_recent_batches()
+                    except Exception as e:
+                        st.error(f"⚠️ Could not submit batch: {e}")
+            elif st.button("Run bulk questions"):
+                try:
+                    questions = read_questions(upload.getvalue())
+                except (UnicodeDecodeError, csv.Error) as e:
+                    st.error(f"⚠️ Could not read CSV (save it as UTF-8 CSV): {e}")
+                else:
+                    with st.spinner(f"Processing {len(questions)} questions..."):
+                        answers = run_async(process_batch(questions))
+                    st.session_state["bulk_results"] = [
+                        {"question": q, "answer": a} for q, a in zip(questions, answers)
+                    ]
+        if st.session_state.get("bulk_results"):
+            results = st.session_state["bulk_results"]
+            st.dataframe(results, use_container_width=True)
+            st.download_button("Download results", results_csv(results), "bulk_results.csv", "text/csv")
+
+        if st.button("🔄 Refresh submitted batches"):
+            load_recent_batches()
+        recent = st.session_state.get("recent_batches", [])
+        if recent:
+            st.markdown("**Submitted batches:**")
+        for batch_id, status, created_at, results in recent:
+            st.caption(f"`{batch_id}` — {status} — submitted {created_at[:16]}")
+            if results:
+                st.download_button(
+                    "Download batch results", results_csv(json.loads(results)),
+                    f"{batch_id}.csv", "text/csv", key=f"dl_{batch_id}"
+                )
+
     # Fresh chat starts here
     user_input = st.chat_input("Your message...")
     if user_input:
@@ -472,26 +1076,27 @@ elif st.session_state.stage == "chat":
 
         # MEDICAL-ONLY VALIDATION
         is_ok, reason = validate_question(user_input)
-        if not is_ok:
-            reply = reason  # fixed out-of-scope message
-        else:
-            try:
-                # Build messages: prepend the system message if this langgraph build didn’t accept a modifier
-                msgs = [("user", user_input)]
-                if _NEED_SYSTEM_PER_CALL:
-                    msgs = [("system", SYSTEM_PROMPT)] + msgs
-
-                # LangGraph expects {"messages": ...} and returns state with a messages list
-                state = agent_executor.invoke({"messages": msgs})
-                last_msg = state["messages"][-1]
-                reply = getattr(last_msg, "content", str(last_msg))
-            except Exception as e:
-                reply = f"⚠️ Could not process: {e}"
 
         # Show & log assistant reply
         with st.chat_message(ASSISTANT_NAME, avatar=ASSISTANT_AVATAR):
-            st.markdown(reply)
+            if not is_ok:
+                reply = reason  # fixed out-of-scope message
+                st.markdown(reply)
+            elif (cached := lookup_faq(user_input)) is not None:
+                reply = cached  # recurring question: answered without the LLM
+                st.markdown(reply)
+            else:
+                turn = {"notes": [], "answer": None}
+                try:
+                    streamed = st.write_stream(iter_async(astream_turn(user_input, turn)))
+                    # Log the final answer only, not any text the model sent with its tool calls
+                    reply = turn["answer"] if isinstance(turn["answer"], str) else streamed
+                except Exception as e:
+                    reply = f"⚠️ Could not process: {e}"
+                    st.markdown(reply)
+                buffer_soap(st.session_state.patient_id, st.session_state.professional_id, turn["notes"])
         log_msg(st.session_state.patient_id, st.session_state.professional_id, "assistant", reply)
+        flush_logs()
 
         # Persist any generated SOAP notes
         save_soap(st.session_state.patient_id, st.session_state.professional_id)